@@ -1,18 +1,46 @@
-import jax
-jax.config.update("jax_enable_x64", True)
 import jax.numpy as jnp
-from jax.numpy.fft import ifftn, ifftshift
+import numpy as np
+from functools import lru_cache
+from jax.numpy.fft import ifftn
+
+
+@lru_cache(maxsize=16)
+def ifftshift_phase(Nx, Ny, Nz):
+    """
+    Phase factor such that ifftn(ifftshift(Xk)) = ifftn(Xk) * ifftshift_phase(Nx, Ny, Nz).
+    Returns exp(-2 pi i ((Nx // 2) x / Nx + (Ny // 2) y / Ny + (Nz // 2) z / Nz)) on the index grid, as a read-only complex
+    NumPy array of shape (Nx, Ny, Nz).
+    """
+    
+    # Undoing the centering of the Fourier modes is a shift by N//2 along each axis, which becomes a phase in real space.
+    x, y, z = np.meshgrid(np.arange(Nx), np.arange(Ny), np.arange(Nz), indexing='ij')
+    
+    phase = np.exp(-2j * np.pi * ((Nx // 2) * x / Nx + (Ny // 2) * y / Ny + (Nz // 2) * z / Nz))
+    phase.flags.writeable = False
+    
+    return phase
+
+
+def inverse_Fourier_transform(Ck, Fk, Nx, Ny, Nz):
+    """
+    Transform centered Hermite-Fourier coefficients Ck (species axis at -5) and field coefficients Fk back to real space.
+    """
+    
+    # Stack Ck (with species and Hermite axes merged) and Fk so both go through a single ifftn,
+    # and apply the ifftshift as a phase on the output.
+    Ck_modes = Ck.reshape(Ck.shape[:-5] + (-1,) + Ck.shape[-3:])
+    CF = ifftn(jnp.concatenate([Ck_modes, Fk], axis=-4), axes=(-3, -2, -1)) * ifftshift_phase(Nx, Ny, Nz)
+    
+    return CF[..., :-6, :, :, :].reshape(Ck.shape), CF[..., -6:, :, :, :]
 
 
 def compute_energy(Ck, Fk, Omega_ce, mi_me, alpha_s, u_s, Lx, Ly, Lz, Nx, Ny, Nz, Nvx, Nvy, Nvz, Nn, Nm, Np):
     
-    F = ifftn(ifftshift(Fk, axes=(-3, -2, -1)), axes=(-3, -2, -1))
+    C, F = inverse_Fourier_transform(Ck, Fk, Nx, Ny, Nz)
     E, B = F[:, :3, ...].real, F[:, 3:, ...].real
-        
-    C = ifftn(ifftshift(Ck, axes=(-3, -2, -1)), axes=(-3, -2, -1))
     
-    Ce = C[:, :(Nn * Nm * Np), ...].real
-    Ci = C[:, (Nn * Nm * Np):, ...].real
+    Ce = C[:, 0, ...].real
+    Ci = C[:, 1, ...].real
     
     # x = jnp.linspace(0, Lx, Nx)
     # y = jnp.linspace(0, Ly, Ny)
@@ -6,18 +6,23 @@ Created on Sun Jun 23 10:55:45 2024
 """
 
 import jax
-jax.config.update("jax_enable_x64", True)
 import jax.numpy as jnp
-from jax.scipy.signal import convolve
-from jax.numpy.fft import fftn, ifftn, fftshift, ifftshift, fftfreq
-from jax.scipy.special import factorial
+import numpy as np
+from jax.numpy.fft import fftn, ifftn
+from jax.scipy.special import factorial, gammaln
 from jax.scipy.integrate import trapezoid
-from jax.experimental.ode import odeint
 # from quadax import quadgk
-from diffrax import diffeqsolve, Dopri5, ODETerm, SaveAt, PIDController
-from functools import partial
+from diffrax import diffeqsolve, Tsit5, ODETerm, SaveAt, PIDController, ConstantStepSize, TqdmProgressMeter, NoProgressMeter
+# jax.shard_map is only public in recent JAX versions; older ones provide it in jax.experimental.
+try:
+    from jax import shard_map
+except ImportError:
+    from jax.experimental.shard_map import shard_map
+from jax.sharding import Mesh, NamedSharding, PartitionSpec as P
+from functools import partial, lru_cache
 from Examples_1D import density_perturbation_1D, density_perturbation_solution, Landau_damping_1D, Landau_damping_HF_1D
 from Examples_2D import Kelvin_Helmholtz_2D
+from Energy import compute_energy, ifftshift_phase
 
 
 def Hermite(n, x):
@@ -53,6 +58,37 @@ def generate_Hermite_basis(xi_x, xi_y, xi_z, Nn, Nm, Np, indices):
     return Hermite_basis
 
 
+def Hermite_at_zero(n):
+    """
+    Normalized Hermite polynomial at zero, H_n(0) / sqrt(2^n n!).
+    It vanishes for odd n and equals (-1)^(n/2) sqrt(n!) / (2^(n/2) (n/2)!) for even n (evaluated in log space).
+    """
+    
+    k = n // 2
+    
+    return jnp.where(n % 2 == 0, (-1.0) ** k * jnp.exp(0.5 * gammaln(n + 1) - k * jnp.log(2.0) - gammaln(k + 1)), 0.0)
+
+
+def inverse_HF_transform_1D(C, alpha, u, vx, Nn, Nm, Np):
+    """
+    Distribution function of one species on the slice vy = u[1], vz = u[2] (xi_y = xi_z = 0), at velocities vx.
+    C holds the real-space Hermite coefficients of that species, with shape (..., Nn * Nm * Np, Nx, Ny, Nz);
+    the result has shape (..., Nx, Ny, Nz, len(vx)).
+    """
+    
+    # Contract the m and p Hermite modes with the basis evaluated at xi_y = xi_z = 0. This leaves a sum over n only.
+    C_nmp = C.reshape(C.shape[:-4] + (Np, Nm, Nn) + C.shape[-3:])
+    C_n = jnp.einsum('...pmnxyz,m,p->...nxyz', C_nmp, Hermite_at_zero(jnp.arange(Nm)), Hermite_at_zero(jnp.arange(Np)))
+    
+    # Hermite basis along vx (see generate_Hermite_basis), for every n.
+    xi_x = (vx - u[0]) / alpha[0]
+    n = jnp.arange(Nn)
+    Hermite_basis_x = (jax.vmap(Hermite, in_axes=(0, None))(n, xi_x) * jnp.exp(-xi_x ** 2) / 
+                       jnp.sqrt((jnp.pi) ** 3 * 2 ** n * factorial(n))[:, None])
+    
+    return jnp.einsum('...nxyz,nv->...xyzv', C_n, Hermite_basis_x)
+
+
 def moving_average(data, window_size):
     """
     I have to add docstrings!
@@ -80,6 +116,9 @@ def compute_C_nmp(f, alpha, u, Nx, Ny, Nz, Lx, Ly, Lz, Nn, Nm, Np, indices):
     vx = jnp.linspace(-5 * alpha[0] + u[0], 5 * alpha[0] + u[0], 40)
     vy = jnp.linspace(-5 * alpha[1] + u[1], 5 * alpha[1] + u[1], 40)
     vz = jnp.linspace(-5 * alpha[2] + u[2], 5 * alpha[2] + u[2], 40)
+    
+    # Spatial grid is built once, with trailing unit axes, and broadcast against each velocity block.
+    X, Y, Z = (grid[..., None, None, None] for grid in jnp.meshgrid(x, y, z, indexing='ij'))
       
     def add_C_nmp(i, C_nmp):
         ivx = jnp.floor(i / (5 ** 2)).astype(int)
@@ -90,7 +129,9 @@ def compute_C_nmp(f, alpha, u, Nx, Ny, Nz, Lx, Ly, Lz, Nn, Nm, Np, indices):
         vy_slice = jax.lax.dynamic_slice(vy, (ivy * 8,), (8,))
         vz_slice = jax.lax.dynamic_slice(vz, (ivz * 8,), (8,))
         
-        X, Y, Z, Vx, Vy, Vz = jnp.meshgrid(x, y, z, vx_slice, vy_slice, vz_slice, indexing='ij')
+        Vx = vx_slice[:, None, None]
+        Vy = vy_slice[None, :, None]
+        Vz = vz_slice[None, None, :]
 
         # Define variables for Hermite polynomials.
         xi_x = (Vx - u[0]) / alpha[0]
@@ -126,9 +167,9 @@ def initialize_system_xp(Omega_ce, mi_me, alpha_s, u_s, Lx, Ly, Lz, Nx, Ny, Nz,
             None, None, None, None, None, None, None, None, None, None, None, None, 0))
         (fi, alpha_s[3:], u_s[3:], Nx, Ny, Nz, Lx, Ly, Lz, Nn, Nm, Np, jnp.arange(Nn * Nm * Np)))
 
-    # Combine Ce_0 and Ci_0 into single array and compute the fast Fourier transform.
+    # Combine Ce_0 and Ci_0 into single array of shape (Ns, Nn * Nm * Np, Nx, Ny, Nz) and compute the fast Fourier transform.
     
-    C_0 = jnp.concatenate([Ce_0, Ci_0])
+    C_0 = jnp.stack([Ce_0, Ci_0])
     
     ############################################################################################################   
     # Attempt to generalize to more than two species (work in progress).
@@ -145,7 +186,10 @@ def initialize_system_xp(Omega_ce, mi_me, alpha_s, u_s, Lx, Ly, Lz, Nx, Ny, Nz,
     
     ############################################################################################################
     
-    Ck_0 = fftshift(fftn(C_0, axes=(-3, -2, -1)), axes=(-3, -2, -1))
+    # Centering the Fourier modes (fftshift) is applied as the conjugate of the ifftshift phase on the real-space input.
+    fftshift_phase = ifftshift_phase(Nx, Ny, Nz).conj()
+    
+    Ck_0 = fftn(C_0 * fftshift_phase, axes=(-3, -2, -1))
     
     # Define 3D grid for functions E(x, y, z) and B(x, y, z).
     x = jnp.linspace(0, Lx, Nx)
@@ -155,98 +199,91 @@ def initialize_system_xp(Omega_ce, mi_me, alpha_s, u_s, Lx, Ly, Lz, Nx, Ny, Nz,
     
     # Combine E and B into single array and compute the fast Fourier transform.
     F_0 = jnp.concatenate([E(X, Y, Z), B(X, Y, Z)])
-    Fk_0 = fftshift(fftn(F_0, axes=(-3, -2, -1)), axes=(-3, -2, -1))
+    Fk_0 = fftn(F_0 * fftshift_phase, axes=(-3, -2, -1))
     
     return Ck_0, Fk_0
 
 
 def cross_product(k_vec, F_vec):
     """
-    I have to add docstrings!
+    Compute k x F along axis -4, broadcasting k_vec over any leading (batch) axes of F_vec.
     """
     
-    # Separate vectors into x, y, z components.
-    kx, ky, kz = k_vec
-    Fx, Fy, Fz = F_vec
-    
-    # Compute the cross product k x F.
-    result_x = ky * Fz - kz * Fy
-    result_y = kz * Fx - kx * Fz
-    result_z = kx * Fy - ky * Fx
+    return jnp.cross(k_vec, F_vec, axis=-4)
 
-    return jnp.array([result_x, result_y, result_z])
 
-
-def compute_dCk_s_dt(Ck, Fk, kx_grid, ky_grid, kz_grid, Lx, Ly, Lz, nu, alpha_s, u_s, qs, Omega_cs, Nn, Nm, Np, indices):
+def compute_dCk_s_dt(Ck, Ck_hat, mode_offset, Fk_hat, kx_grid, ky_grid, kz_grid, Lx, Ly, Lz, nu, alpha, u, q, Omega_c, Nn, Nm, Np, indices):
     """
     I have to add docstrings!
     """
     
-    # Species. s = 0 corresponds to electrons and s = 1 corresponds to ions.
-    s = jnp.floor(indices / (Nn * Nm * Np)).astype(int)
-    
+    # Ck, Ck_hat, alpha, u, q, and Omega_c are those of a single species; ode_system vectorizes over species.
+    # Ck_hat and Fk_hat are the zero-padded FFTs of Ck and Fk (see ode_system), so products of them are linear convolutions.
+    # Ck_hat only covers the modes from mode_offset on (those coupled to indices), so it is indexed relative to mode_offset.
+    Nx, Ny, Nz = Ck.shape[-3:]
     # Indices below represent order of Hermite polynomials (they identify the Hermite-Fourier coefficients Ck[n, p, m]).
-    p = jnp.floor((indices - s * Nn * Nm * Np) / (Nn * Nm)).astype(int)
-    m = jnp.floor((indices - s * Nn * Nm * Np - p * Nn * Nm) / Nn).astype(int)
-    n = (indices - s * Nn * Nm * Np - p * Nn * Nm - m * Nn).astype(int)
-    
-    # Define u, alpha, charge, and gyrofrequency depending on species.
-    u = jax.lax.dynamic_slice(u_s, (s * 3,), (3,))
-    alpha = jax.lax.dynamic_slice(alpha_s, (s * 3,), (3,))
-    q, Omega_c = qs[s], Omega_cs[s]
-    
-    # Define terms to be used in ODEs below.
-    Ck_aux_x = (jnp.sqrt(m * p) * (alpha[2] / alpha[1] - alpha[1] / alpha[2]) * Ck[n + (m-1) * Nn + (p-1) * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(m) * jnp.sign(p) + 
-        jnp.sqrt(m * (p + 1)) * (alpha[2] / alpha[1]) * Ck[n + (m-1) * Nn + (p+1) * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(m) * jnp.sign(Np - p - 1) - 
-        jnp.sqrt((m + 1) * p) * (alpha[1] / alpha[2]) * Ck[n + (m+1) * Nn + (p-1) * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(p) * jnp.sign(Nm - m - 1) + 
-        jnp.sqrt(2 * m) * (u[2] / alpha[1]) * Ck[n + (m-1) * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(m) - 
-        jnp.sqrt(2 * p) * (u[1] / alpha[2]) * Ck[n + m * Nn + (p-1) * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(p)) 
-
-    Ck_aux_y = (jnp.sqrt(n * p) * (alpha[0] / alpha[2] - alpha[2] / alpha[0]) * Ck[n-1 + m * Nn + (p-1) * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(n) * jnp.sign(p) + 
-        jnp.sqrt((n + 1) * p) * (alpha[0] / alpha[2]) * Ck[n+1 + m * Nn + (p-1) * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(p) * jnp.sign(Nn - n - 1) - 
-        jnp.sqrt(n * (p + 1)) * (alpha[2] / alpha[0]) * Ck[n-1 + m * Nn + (p+1) * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(n) * jnp.sign(Np - p - 1) + 
-        jnp.sqrt(2 * p) * (u[0] / alpha[2]) * Ck[n + m * Nn + (p-1) * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(p) - 
-        jnp.sqrt(2 * n) * (u[2] / alpha[0]) * Ck[n-1 + m * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(n))
-    
-    Ck_aux_z = (jnp.sqrt(n * m) * (alpha[1] / alpha[0] - alpha[0] / alpha[1]) * Ck[n-1 + (m-1) * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(n) * jnp.sign(m) + 
-        jnp.sqrt(n * (m + 1)) * (alpha[1] / alpha[0]) * Ck[n-1 + (m+1) * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(n) * jnp.sign(Nm - m - 1) - 
-        jnp.sqrt((n + 1) * m) * (alpha[0] / alpha[1]) * Ck[n+1 + (m-1) * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(m) * jnp.sign(Nn - n - 1) + 
-        jnp.sqrt(2 * n) * (u[1] / alpha[0]) * Ck[n-1 + m * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(n) - 
-        jnp.sqrt(2 * m) * (u[0] / alpha[1]) * Ck[n + (m-1) * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(m))
+    p = jnp.floor(indices / (Nn * Nm)).astype(int)
+    m = jnp.floor((indices - p * Nn * Nm) / Nn).astype(int)
+    n = (indices - p * Nn * Nm - m * Nn).astype(int)
+    
+    # The integer orders only index Ck. Their real-valued copies, in the precision of alpha (that of the solve), enter the
+    # coefficients below, so that a single-precision run is not promoted to double precision.
+    n_f, m_f, p_f = (order.astype(alpha.dtype) for order in (n, m, p))
+    
+    # Define terms to be used in ODEs below. They only enter the convolutions, so build them directly from Ck_hat.
+    Ck_aux_x = (jnp.sqrt(m_f * p_f) * (alpha[2] / alpha[1] - alpha[1] / alpha[2]) * Ck_hat[n + (m-1) * Nn + (p-1) * Nn * Nm - mode_offset, ...] * jnp.sign(m) * jnp.sign(p) + 
+        jnp.sqrt(m_f * (p_f + 1)) * (alpha[2] / alpha[1]) * Ck_hat[n + (m-1) * Nn + (p+1) * Nn * Nm - mode_offset, ...] * jnp.sign(m) * jnp.sign(Np - p - 1) - 
+        jnp.sqrt((m_f + 1) * p_f) * (alpha[1] / alpha[2]) * Ck_hat[n + (m+1) * Nn + (p-1) * Nn * Nm - mode_offset, ...] * jnp.sign(p) * jnp.sign(Nm - m - 1) + 
+        jnp.sqrt(2 * m_f) * (u[2] / alpha[1]) * Ck_hat[n + (m-1) * Nn + p * Nn * Nm - mode_offset, ...] * jnp.sign(m) - 
+        jnp.sqrt(2 * p_f) * (u[1] / alpha[2]) * Ck_hat[n + m * Nn + (p-1) * Nn * Nm - mode_offset, ...] * jnp.sign(p)) 
+
+    Ck_aux_y = (jnp.sqrt(n_f * p_f) * (alpha[0] / alpha[2] - alpha[2] / alpha[0]) * Ck_hat[n-1 + m * Nn + (p-1) * Nn * Nm - mode_offset, ...] * jnp.sign(n) * jnp.sign(p) + 
+        jnp.sqrt((n_f + 1) * p_f) * (alpha[0] / alpha[2]) * Ck_hat[n+1 + m * Nn + (p-1) * Nn * Nm - mode_offset, ...] * jnp.sign(p) * jnp.sign(Nn - n - 1) - 
+        jnp.sqrt(n_f * (p_f + 1)) * (alpha[2] / alpha[0]) * Ck_hat[n-1 + m * Nn + (p+1) * Nn * Nm - mode_offset, ...] * jnp.sign(n) * jnp.sign(Np - p - 1) + 
+        jnp.sqrt(2 * p_f) * (u[0] / alpha[2]) * Ck_hat[n + m * Nn + (p-1) * Nn * Nm - mode_offset, ...] * jnp.sign(p) - 
+        jnp.sqrt(2 * n_f) * (u[2] / alpha[0]) * Ck_hat[n-1 + m * Nn + p * Nn * Nm - mode_offset, ...] * jnp.sign(n))
+    
+    Ck_aux_z = (jnp.sqrt(n_f * m_f) * (alpha[1] / alpha[0] - alpha[0] / alpha[1]) * Ck_hat[n-1 + (m-1) * Nn + p * Nn * Nm - mode_offset, ...] * jnp.sign(n) * jnp.sign(m) + 
+        jnp.sqrt(n_f * (m_f + 1)) * (alpha[1] / alpha[0]) * Ck_hat[n-1 + (m+1) * Nn + p * Nn * Nm - mode_offset, ...] * jnp.sign(n) * jnp.sign(Nm - m - 1) - 
+        jnp.sqrt((n_f + 1) * m_f) * (alpha[0] / alpha[1]) * Ck_hat[n+1 + (m-1) * Nn + p * Nn * Nm - mode_offset, ...] * jnp.sign(m) * jnp.sign(Nn - n - 1) + 
+        jnp.sqrt(2 * n_f) * (u[1] / alpha[0]) * Ck_hat[n-1 + m * Nn + p * Nn * Nm - mode_offset, ...] * jnp.sign(n) - 
+        jnp.sqrt(2 * m_f) * (u[0] / alpha[1]) * Ck_hat[n + (m-1) * Nn + p * Nn * Nm - mode_offset, ...] * jnp.sign(m))
     
     # Define "unphysical" collision operator to eliminate recurrence.
     # Col = -nu * ((n * (n - 1) * (n - 2)) / ((Nn - 1) * (Nn - 2) * (Nn - 3)) + 
     #              (m * (m - 1) * (m - 2)) / ((Nm - 1) * (Nm - 2) * (Nm - 3)) +
-    #              (p * (p - 1) * (p - 2)) / ((Np - 1) * (Np - 2) * (Np - 3))) * Ck[n + m * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...]
-    
-    # Col = -nu * (n * (n - 1) * (n - 2)) / ((Nn - 1) * (Nn - 2) * (Nn - 3)) * Ck[n + m * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...]
-    
-    Col = -nu * ((n * (n - 1) * (n - 2)) / ((Nn - 1) * (Nn - 2) * (Nn - 3)) + 
-                 (m * (m - 1) * (m - 2)) / ((Nm - 1) * (Nm - 2) * (Nm - 3))) * Ck[n + m * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...]
+    #              (p * (p - 1) * (p - 2)) / ((Np - 1) * (Np - 2) * (Np - 3))) * Ck[n + m * Nn + p * Nn * Nm, ...]
+    
+    # Col = -nu * (n * (n - 1) * (n - 2)) / ((Nn - 1) * (Nn - 2) * (Nn - 3)) * Ck[n + m * Nn + p * Nn * Nm, ...]
+    
+    Col = -nu * ((n_f * (n_f - 1) * (n_f - 2)) / ((Nn - 1) * (Nn - 2) * (Nn - 3)) + 
+                 (m_f * (m_f - 1) * (m_f - 2)) / ((Nm - 1) * (Nm - 2) * (Nm - 3))) * Ck[n + m * Nn + p * Nn * Nm, ...]
+    
+    # Sum all the convolutions with E and B in Fourier space and transform back once. Cropping the central
+    # Nx x Ny x Nz block of the full linear convolution is equivalent to convolve(..., mode='same').
+    convolution = ifftn(
+        (jnp.sqrt(2 * n_f) / alpha[0]) * Fk_hat[0, ...] * Ck_hat[n-1 + m * Nn + p * Nn * Nm - mode_offset, ...] * jnp.sign(n) +
+        (jnp.sqrt(2 * m_f) / alpha[1]) * Fk_hat[1, ...] * Ck_hat[n + (m-1) * Nn + p * Nn * Nm - mode_offset, ...] * jnp.sign(m) +
+        (jnp.sqrt(2 * p_f) / alpha[2]) * Fk_hat[2, ...] * Ck_hat[n + m * Nn + (p-1) * Nn * Nm - mode_offset, ...] * jnp.sign(p) + 
+        Fk_hat[3, ...] * Ck_aux_x + 
+        Fk_hat[4, ...] * Ck_aux_y + 
+        Fk_hat[5, ...] * Ck_aux_z, axes=(-3, -2, -1))
         
     # Define ODEs for Hermite-Fourier coefficients.
     # Clossure is achieved by setting to zero coefficients with index out of range.
     dCk_s_dt = (- (kx_grid * 1j / Lx) * alpha[0] * (
-        jnp.sqrt((n + 1) / 2) * Ck[n+1 + m * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(Nn - n - 1) +
-        jnp.sqrt(n / 2) * Ck[n-1 + m * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(n) +
-        (u[0] / alpha[0]) * Ck[n + m * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...]
+        jnp.sqrt((n_f + 1) / 2) * Ck[n+1 + m * Nn + p * Nn * Nm, ...] * jnp.sign(Nn - n - 1) +
+        jnp.sqrt(n_f / 2) * Ck[n-1 + m * Nn + p * Nn * Nm, ...] * jnp.sign(n) +
+        (u[0] / alpha[0]) * Ck[n + m * Nn + p * Nn * Nm, ...]
     ) - (ky_grid * 1j / Ly) * alpha[1] * (
-        jnp.sqrt((m + 1) / 2) * Ck[n + (m+1) * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(Nm - m - 1) +
-        jnp.sqrt(m / 2) * Ck[n + (m-1) * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(m) +
-        (u[1] / alpha[1]) * Ck[n + m * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...]
+        jnp.sqrt((m_f + 1) / 2) * Ck[n + (m+1) * Nn + p * Nn * Nm, ...] * jnp.sign(Nm - m - 1) +
+        jnp.sqrt(m_f / 2) * Ck[n + (m-1) * Nn + p * Nn * Nm, ...] * jnp.sign(m) +
+        (u[1] / alpha[1]) * Ck[n + m * Nn + p * Nn * Nm, ...]
     ) - (kz_grid * 1j / Lz) * alpha[2] * (
-        jnp.sqrt((p + 1) / 2) * Ck[n + m * Nn + (p+1) * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(Np - p - 1) +
-        jnp.sqrt(p / 2) * Ck[n + m * Nn + (p-1) * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(p) +
-        (u[2] / alpha[2]) * Ck[n + m * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...]
-    ) + q * Omega_c * (
-        (jnp.sqrt(2 * n) / alpha[0]) * convolve(Fk[0, ...], Ck[n-1 + m * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(n), mode='same') +
-        (jnp.sqrt(2 * m) / alpha[1]) * convolve(Fk[1, ...], Ck[n + (m-1) * Nn + p * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(m), mode='same') +
-        (jnp.sqrt(2 * p) / alpha[2]) * convolve(Fk[2, ...], Ck[n + m * Nn + (p-1) * Nn * Nm + s * Nn * Nm * Np, ...] * jnp.sign(p), mode='same')
-    ) + q * Omega_c * (
-        convolve(Fk[3, ...], Ck_aux_x, mode='same') + 
-        convolve(Fk[4, ...], Ck_aux_y, mode='same') + 
-        convolve(Fk[5, ...], Ck_aux_z, mode='same')
-    ) + Col)
+        jnp.sqrt((p_f + 1) / 2) * Ck[n + m * Nn + (p+1) * Nn * Nm, ...] * jnp.sign(Np - p - 1) +
+        jnp.sqrt(p_f / 2) * Ck[n + m * Nn + (p-1) * Nn * Nm, ...] * jnp.sign(p) +
+        (u[2] / alpha[2]) * Ck[n + m * Nn + p * Nn * Nm, ...]
+    ) + q * Omega_c * convolution[(Nx - 1) // 2:(Nx - 1) // 2 + Nx, (Ny - 1) // 2:(Ny - 1) // 2 + Ny, (Nz - 1) // 2:(Nz - 1) // 2 + Nz] + Col)
     
     return dCk_s_dt
 
@@ -256,48 +293,85 @@ def ampere_maxwell_current(qs, alpha_s, u_s, Ck, Nn, Nm, Np, Ns):
     I have to add docstrings!
     """
       
-    # Add next term in the current. Body function of fori_loop below.
-    def add_current_term(s, partial_sum):
-        return partial_sum + qs[s] * alpha_s[s * 3] * alpha_s[s * 3 + 1] * alpha_s[s * 3 + 2] * (
-            (1 / jnp.sqrt(2)) * jnp.array([alpha_s[s * 3] * Ck[s * Nn * Nm * Np + 1, ...] * jnp.sign(Nn - 1),
-                                           alpha_s[s * 3 + 1] * Ck[s * Nn * Nm * Np + Nn + 1, ...] * jnp.sign(Nm - 1),
-                                           alpha_s[s * 3 + 2] * Ck[s * Nn * Nm * Np + Nn * Nm + 1, ...] * jnp.sign(Np - 1)]) + 
-                                jnp.array([u_s[s * 3] * Ck[s * Nn * Nm * Np, ...],
-                                           u_s[s * 3 + 1] * Ck[s * Nn * Nm * Np, ...],
-                                           u_s[s * 3 + 2] * Ck[s * Nn * Nm * Np, ...]]))
+    # Current carried by a single species, with coefficients Ck of shape (Nn * Nm * Np, Nx, Ny, Nz).
+    def species_current(q, alpha, u, Ck):
+        return q * alpha[0] * alpha[1] * alpha[2] * (
+            (1 / jnp.sqrt(2)) * jnp.array([alpha[0] * Ck[1, ...] * jnp.sign(Nn - 1),
+                                           alpha[1] * Ck[Nn + 1, ...] * jnp.sign(Nm - 1),
+                                           alpha[2] * Ck[Nn * Nm + 1, ...] * jnp.sign(Np - 1)]) + 
+                                jnp.array([u[0] * Ck[0, ...],
+                                           u[1] * Ck[0, ...],
+                                           u[2] * Ck[0, ...]]))
     
     # Return full current for Ns particle species.
-    return jax.lax.fori_loop(0, Ns, add_current_term, jnp.zeros_like(Ck[:3, ...]))
+    return jnp.sum(jax.vmap(species_current)(qs, alpha_s.reshape(Ns, 3), u_s.reshape(Ns, 3), Ck), axis=0)
 
 
-def ode_system(Ck_Fk, t, qs, nu, Omega_cs, alpha_s, u_s, Lx, Ly, Lz, Nx, Ny, Nz, Nn, Nm, Np, Ns):     
+def ode_system(y, t, qs, nu, Omega_cs, alpha_s, u_s, kx_grid, ky_grid, kz_grid, k_vec, mesh, indices, Lx, Ly, Lz, Nx, Ny, Nz, Nn, Nm, Np, Ns):     
     
-    # Define wave vectors.
-    kx = (jnp.arange(-Nx//2, Nx//2) + 1) * 2 * jnp.pi
-    ky = (jnp.arange(-Ny//2, Ny//2) + 1) * 2 * jnp.pi
-    kz = (jnp.arange(-Nz//2, Nz//2) + 1) * 2 * jnp.pi
+    # The state holds the coefficients of the distribution functions (Ck) and of the electric and magnetic fields (Fk).
+    Ck, Fk = y['C'], y['F']
     
-
-    # Create 3D grids of kx, ky, kz.
-    kx_grid, ky_grid, kz_grid = jnp.meshgrid(kx, ky, kz, indexing='ij')
-    
-    # Separate between initial conditions for distribution functions (coefficients Ck)
-    # and electric and magnetic fields (coefficients Fk).
-    Ck = Ck_Fk[:(-6 * Nx * Ny * Nz)].reshape(Ns * Nn * Nm * Np, Nx, Ny, Nz)
-    Fk = Ck_Fk[(-6 * Nx * Ny * Nz):].reshape(6, Nx, Ny, Nz)
-    
-    # Vectorize over n, m, p, and s to generate ODEs for all coefficients Ck.
-    dCk_s_dt = (jax.vmap(
+    # Vectorize over n, m, p (inner) and over species s (outer) to generate ODEs for all coefficients Ck.
+    dCk_s_dt_modes = jax.vmap(
         compute_dCk_s_dt, 
-        in_axes=(None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, 0))
-        (Ck, Fk, kx_grid, ky_grid, kz_grid, Lx, Ly, Lz, nu, alpha_s, u_s, qs, Omega_cs, Nn, Nm, Np, jnp.arange(Nn * Nm * Np * Ns)))
+        in_axes=(None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, None, 0))
+    
+    if mesh.size > 1 and mesh.devices.flat[0].platform == 'cpu':
+        # On multi-device CPU meshes, map over species with lax.map instead: with a (species, modes) batch, XLA lays out
+        # the per-mode coefficients hoisted out of the RK4 scan column-major, and the CPU runtime rejects the resulting
+        # IFFT operand layout.
+        def dCk_dt_modes(Ck, Ck_hat, mode_offset, Fk_hat, kx_grid, ky_grid, kz_grid, Lx, Ly, Lz, nu, alpha_s, u_s, qs, Omega_cs, Nn, Nm, Np, indices):
+            return jax.lax.map(lambda species: dCk_s_dt_modes(species[0], species[1], mode_offset, Fk_hat, kx_grid, ky_grid, kz_grid, 
+                                                              Lx, Ly, Lz, nu, *species[2:], Nn, Nm, Np, indices), 
+                               (Ck, Ck_hat, alpha_s, u_s, qs, Omega_cs))
+    else:
+        dCk_dt_modes = jax.vmap(
+            dCk_s_dt_modes, 
+            in_axes=(0, 0, None, None, None, None, None, None, None, None, None, 0, 0, 0, 0, None, None, None, None))
+    
+    # A mode n + m * Nn + p * Nn * Nm couples to its neighbours in n, m and p, at most halo modes away.
+    Nmodes = Nn * Nm * Np
+    halo = (Nn > 1) + Nn * (Nm > 1) + Nn * Nm * (Np > 1)
+    
+    def local_dCk_dt(indices, Ck, Fk, kx_grid, ky_grid, kz_grid):
+        # The modes of each device are contiguous (the padding of indices is at the end), so together with the modes they
+        # couple to they fit in a window of Ck starting at mode_offset. Only that window is transformed below.
+        window = min(len(indices) + 2 * halo, Nmodes)
+        mode_offset = jnp.clip(indices[0] - halo, 0, Nmodes - window)
+        Ck_window = jax.lax.dynamic_slice_in_dim(Ck, mode_offset, window, axis=1)
+        
+        # Zero-padded FFTs of the window of Ck and of Fk, taken together in a single batched fftn. Products of these
+        # transforms give the linear convolutions in the nonlinear terms of compute_dCk_s_dt.
+        CFk_hat = fftn(jnp.concatenate([Ck_window.reshape(Ns * window, Nx, Ny, Nz), Fk]), 
+                       s=(2 * Nx - 1, 2 * Ny - 1, 2 * Nz - 1), axes=(-3, -2, -1))
+        Ck_hat = CFk_hat[:-6, ...].reshape(Ns, window, 2 * Nx - 1, 2 * Ny - 1, 2 * Nz - 1)
+        Fk_hat = CFk_hat[-6:, ...]
+        
+        return dCk_dt_modes(Ck, Ck_hat, mode_offset, Fk_hat, kx_grid, ky_grid, kz_grid, Lx, Ly, Lz, nu, 
+                            alpha_s.reshape(Ns, 3), u_s.reshape(Ns, 3), qs, Omega_cs, Nn, Nm, Np, indices)
+    
+    # Shard the Hermite modes across devices. Each device holds the full Ck and Fk and transforms the window of Ck its
+    # modes need, so the convolutions stay local and the only communication is gathering dCk_s_dt at the end.
+    # Memory: Ck_hat has 2N - 1 points per direction, so it is about 4x the size of its window of Ck in 2-D and 8x in 3-D.
+    # XLA fuses the gathered Ck_hat products of compute_dCk_s_dt into the sum that feeds the inverse FFT, so they are
+    # not stored per mode. On one device (where the window is all of Ck), the peak temporary memory of one right-hand
+    # side evaluation on CPU is about 8x (2-D) and 15x (3-D) the size of the state, against 16x for the direct
+    # convolve this replaced. With more devices, the forward FFTs and Ck_hat shrink with the number of modes per device,
+    # until the halo spans all modes: on 4 devices, with Nx = Ny = 32, Nz = 1 and Ns = 2, the peak per device drops from
+    # 17.2 MB to 9.6 MB for Nn = Nm = 8 and Np = 1 (74 instead of 134 forward FFTs), and stays near 5 MB for Nn = Nm = 4.
+    dCk_s_dt = shard_map(
+        local_dCk_dt, mesh=mesh, in_specs=(P('modes'), P(), P(), P(), P(), P()), out_specs=P(None, 'modes'))(
+        indices, Ck, Fk, kx_grid, ky_grid, kz_grid)[:, :Nmodes]
     
     
     current = ampere_maxwell_current(qs, alpha_s, u_s, Ck, Nn, Nm, Np, Ns)
         
     # Generate ODEs for Bk and Ek.
-    dBk_dt = - 1j * cross_product(jnp.array([kx_grid/Lx, ky_grid/Ly, kz_grid/Lz]), Fk[:3, ...])
-    dEk_dt = 1j * cross_product(jnp.array([kx_grid/Lx, ky_grid/Ly, kz_grid/Lz]), Fk[3:, ...]) - (1 / Omega_cs[0]) * current
+    # Compute k x E and k x B with a single cross product.
+    k_cross_Fk = cross_product(k_vec, Fk.reshape(2, 3, Nx, Ny, Nz))
+    dBk_dt = - 1j * k_cross_Fk[0]
+    dEk_dt = 1j * k_cross_Fk[1] - (1 / Omega_cs[0]) * current
             
             # (qs[0] * alpha_s[0] * alpha_s[1] * alpha_s[2] * (
             # (1 / jnp.sqrt(2)) * jnp.array([alpha_s[0] * Ck[1, ...] * jnp.sign(Nn - 1),
@@ -314,35 +388,192 @@ def ode_system(Ck_Fk, t, qs, nu, Omega_cs, alpha_s, u_s, Lx, Ly, Lz, Nx, Ny, Nz,
             #                                u_s[4] * Ck[Nn * Nm * Np, ...],
             #                                u_s[5] * Ck[Nn * Nm * Np, ...]])))
 
-    # Combine dC/dt and dF/dt into a single array and flatten it into a 1D array for an ODE solver.
+    # Return dC/dt and dF/dt with the same structure as the state.
     dFk_dt = jnp.concatenate([dEk_dt, dBk_dt])
-    dy_dt = jnp.concatenate([dCk_s_dt.flatten(), dFk_dt.flatten()])
     
-    return dy_dt
+    return {'C': dCk_s_dt, 'F': dFk_dt}
 
 
-@partial(jax.jit, static_argnums=[9, 10, 11, 12, 13, 14, 15, 17])
-def VM_simulation(qs, nu, Omega_cs, alpha_s, mi_me, u_s, Lx, Ly, Lz, Nx, Ny, Nz, Nn, Nm, Np, Ns, t_max, t_steps):
+@lru_cache(maxsize=16)
+def wavenumber_grids(Nx, Ny, Nz):
+    """
+    3D grids of the (centered) wavenumbers kx, ky, kz times 2 * pi, for Nx x Ny x Nz Fourier modes.
+    Returns a tuple of three NumPy arrays of shape (Nx, Ny, Nz). They are cached per grid size and shared between calls,
+    so they are read-only.
+    """
+    
+    # Define wave vectors.
+    kx = (np.arange(-Nx//2, Nx//2) + 1) * 2 * np.pi
+    ky = (np.arange(-Ny//2, Ny//2) + 1) * 2 * np.pi
+    kz = (np.arange(-Nz//2, Nz//2) + 1) * 2 * np.pi
+    
+    # Create 3D grids of kx, ky, kz. They are shared between calls, so make them read-only.
+    k_grids = np.meshgrid(kx, ky, kz, indexing='ij')
+    for k_grid in k_grids:
+        k_grid.flags.writeable = False
+    
+    return tuple(k_grids)
+
+
+def estimate_substeps(nu, Omega_cs, alpha_s, u_s, Lx, Ly, Lz, Nx, Ny, Nz, Nn, Nm, Np, Ns, t_max, t_steps, cfl=1.0):
+    """
+    Estimate the number of constant time steps per output interval needed to resolve the fastest linear frequency.
+    Must be called with concrete (non-traced) parameters, since the result is a static argument of _VM_simulation.
+    """
+    
+    # Largest wavenumbers along each direction.
+    k_max = 2 * jnp.pi * jnp.array([(Nx // 2) / Lx, (Ny // 2) / Ly, (Nz // 2) / Lz])
+    
+    # Free streaming of the highest Hermite mode (largest root of H_N is about sqrt(2N)) plus drift, for each species.
+    N_max = jnp.array([Nn, Nm, Np])
+    omega_streaming = jnp.max(jnp.array([jnp.sum(k_max * (alpha_s[s * 3:(s + 1) * 3] * jnp.sqrt(2 * N_max) + 
+                                                          jnp.abs(u_s[s * 3:(s + 1) * 3]))) for s in range(Ns)]))
+    
+    # Light waves, plasma and gyration frequencies, and the collisional damping rate.
+    omega_max = jnp.maximum(omega_streaming, jnp.linalg.norm(k_max)) + 1 + jnp.max(jnp.abs(Omega_cs)) + 2 * nu
+    
+    # A single output time (t_steps == 1) needs no steps.
+    if t_steps == 1:
+        return 1
+    
+    return max(1, int(jnp.ceil((t_max / (t_steps - 1)) * omega_max / cfl)))
+
+
+def VM_simulation(qs, nu, Omega_cs, alpha_s, mi_me, u_s, Lx, Ly, Lz, Nx, Ny, Nz, Nn, Nm, Np, Ns, t_max, t_steps, 
+                  nsub=None, adaptive=False, progress=False, diagnostics_only=False, dtype=jnp.complex128, scan=True):
+    """
+    Solve the Vlasov-Maxwell system over t_steps output times in [0, t_max].
+    nsub is the number of constant time steps per output interval. If it is None, it is estimated with estimate_substeps,
+    which needs concrete (non-traced) parameters.
+    """
+    
+    if nsub is None:
+        nsub = estimate_substeps(nu, Omega_cs, alpha_s, u_s, Lx, Ly, Lz, Nx, Ny, Nz, Nn, Nm, Np, Ns, t_max, t_steps)
+    
+    return _VM_simulation(qs, nu, Omega_cs, alpha_s, mi_me, u_s, Lx, Ly, Lz, Nx, Ny, Nz, Nn, Nm, Np, Ns, t_max, t_steps, 
+                          nsub, adaptive, progress, diagnostics_only, dtype, scan)
+
+
+@partial(jax.jit, static_argnums=[9, 10, 11, 12, 13, 14, 15, 17, 18, 19, 20, 21, 22, 23])
+def _VM_simulation(qs, nu, Omega_cs, alpha_s, mi_me, u_s, Lx, Ly, Lz, Nx, Ny, Nz, Nn, Nm, Np, Ns, t_max, t_steps, 
+                   nsub, adaptive, progress, diagnostics_only, dtype, scan):
     
    
     # # Load initial conditions.
     Ck_0, Fk_0 = initialize_system_xp(Omega_cs[0], mi_me, alpha_s, u_s, Lx, Ly, Lz, Nx, Ny, Nz, Nn, Nm, Np, Ns)
+    
+    # Solve in the requested precision (complex128 falls back to complex64 unless jax_enable_x64 is set).
+    # Cast the initial conditions and the parameters here, and the wavenumber grids below.
+    real_dtype = jnp.finfo(dtype).dtype
+    Ck_0, Fk_0 = Ck_0.astype(dtype), Fk_0.astype(dtype)
+    qs, nu, Omega_cs, alpha_s, u_s, Lx, Ly, Lz, t_max = (jnp.asarray(a, dtype=real_dtype) for a in (qs, nu, Omega_cs, alpha_s, u_s, Lx, Ly, Lz, t_max))
 
     # Load initial conditions in Hermite-Fourier space.
     # Ck_0, Fk_0 = Landau_damping_HF_1D(Lx, Ly, Lz, Omega_cs[0], alpha_s[0], alpha_s[3], Nn)
     
-    # Combine initial conditions.
-    initial_conditions = jnp.concatenate([Ck_0.flatten(), Fk_0.flatten()])
+    # Combine initial conditions into a PyTree state.
+    initial_conditions = {'C': Ck_0, 'F': Fk_0}
 
     # Define the time array.
     t = jnp.linspace(0, t_max, t_steps)
 
-    # Solve the ODE system.
-    dy_dt = partial(ode_system, qs=qs, nu=nu, Omega_cs=Omega_cs, alpha_s=alpha_s, u_s=u_s, Lx=Lx, Ly=Ly, Lz=Lz, Nx=Nx, Ny=Ny, Nz=Nz, Nn=Nn, Nm=Nm, Np=Np, Ns=Ns)
-    result = odeint(dy_dt, initial_conditions, t)
+    # 3D grids of kx, ky, kz, and the wave vector used in Maxwell's equations.
+    kx_grid, ky_grid, kz_grid = (jnp.asarray(k_grid, dtype=real_dtype) for k_grid in wavenumber_grids(Nx, Ny, Nz))
+    k_vec = jnp.array([kx_grid / Lx, ky_grid / Ly, kz_grid / Lz])
+    
+    # Device mesh over which the Hermite modes are sharded.
+    # Pad the mode indices (with index 0) to a multiple of the number of devices; the padding is dropped in ode_system.
+    mesh = Mesh(jax.devices(), ('modes',))
+    Nmodes = Nn * Nm * Np
+    indices = jnp.zeros(-(-Nmodes // mesh.size) * mesh.size, dtype=int).at[:Nmodes].set(jnp.arange(Nmodes))
+    
+    # Pin the state as replicated, which is what ode_system expects. Otherwise sharding propagation from the
+    # modes-sharded shard_map output splits the state over the mesh, and every step pays extra all-gathers and
+    # all-reduces to reassemble it.
+    initial_conditions = jax.lax.with_sharding_constraint(initial_conditions, NamedSharding(mesh, P()))
+
+    # Right-hand side of the ODE system. It closes over everything precomputed above.
+    def dy_dt(t, y, args):
+        return ode_system(y, t, qs, nu, Omega_cs, alpha_s, u_s, kx_grid, ky_grid, kz_grid, k_vec, mesh, indices, 
+                          Lx, Ly, Lz, Nx, Ny, Nz, Nn, Nm, Np, Ns)
+    
+    # Reduced output: instead of the full state, save only what the 1D diagnostics use at each time.
+    def diagnostics(t, y, args):
+        Ck, Fk = y['C'], y['F']
+        
+        # Remove the equilibrium (n = m = p = 0, k = 0) coefficient of each species.
+        dCk = Ck.at[:, 0, Nx // 2, Ny // 2, Nz // 2].set(0)
+        
+        plasma_energy, EM_energy = compute_energy(Ck[None], Fk[None], Omega_cs[0], mi_me, alpha_s, u_s, 
+                                                  Lx, Ly, Lz, Nx, Ny, Nz, None, None, None, Nn, Nm, Np)
+        
+        # Ck_yz0 holds the coefficients of the y = z = 0 line (Ck summed over ky and kz), which is what the phase-space plot
+        # uses. That line in real space is ifft(ifftshift(Ck_yz0, axes=-1), axis=-1).
+        return {'Ck_kx': Ck[..., Ny // 2, Nz // 2], 'Fk_kx': Fk[..., Ny // 2, Nz // 2], 
+                'Ck_yz0': jnp.sum(Ck, axis=(-2, -1)) / (Ny * Nz), 
+                'C2': jnp.einsum('snxyz,snxyz->sn', dCk.conj(), dCk).real / (Nx * Ny * Nz), 
+                'plasma_energy': plasma_energy[0], 'EM_energy': EM_energy[0]}
+    
+    save = (lambda y: diagnostics(None, y, None)) if diagnostics_only else (lambda y: y)
+    
+    # By default take nsub constant steps per output interval (see estimate_substeps).
+    # Adaptive stepping is opt-in, since step rejections waste right-hand side evaluations on this oscillatory system.
+    # With a single output time (t_steps == 1) there is nothing to integrate, and dt is not used.
+    dt = t_max / (nsub * max(t_steps - 1, 1))
+    
+    if t_steps == 1:
+        ys = jax.tree_util.tree_map(lambda y_0: y_0[None], save(initial_conditions))
+    
+    elif scan and not adaptive:
+        # Constant-step RK4 written as nested lax.scan loops (nsub steps per output interval), so the whole
+        # time integration compiles into a single XLA loop without the diffrax step machinery.
+        def rk4_step(y, _):
+            k1 = dy_dt(None, y, None)
+            k2 = dy_dt(None, jax.tree_util.tree_map(lambda y, k: y + 0.5 * dt * k, y, k1), None)
+            k3 = dy_dt(None, jax.tree_util.tree_map(lambda y, k: y + 0.5 * dt * k, y, k2), None)
+            k4 = dy_dt(None, jax.tree_util.tree_map(lambda y, k: y + dt * k, y, k3), None)
+            return jax.tree_util.tree_map(lambda y, k1, k2, k3, k4: y + dt * (k1 + 2 * k2 + 2 * k3 + k4) / 6, 
+                                          y, k1, k2, k3, k4), None
+        
+        # Each iteration saves the state at t[i] and then advances it to t[i + 1], so the scan writes all t_steps outputs
+        # into its stacked result directly. The advance after the last output is skipped.
+        def output_interval(y, i):
+            y_i = save(y)
+            
+            # Without the diffrax progress meter, report each saved time from the host on request.
+            if progress:
+                jax.debug.print("Saved output {i}/{n} (t = {t})", i=i, n=t_steps - 1, t=t[i])
+            
+            y = jax.lax.cond(i < t_steps - 1, lambda y: jax.lax.scan(rk4_step, y, None, length=nsub)[0], lambda y: y, y)
+            
+            return y, y_i
+        
+        _, ys = jax.lax.scan(output_interval, initial_conditions, jnp.arange(t_steps))
+    
+    else:
+        # Integrate with Tsit5 in diffrax (constant steps, or adaptive on request).
+        if adaptive:
+            stepsize_controller = PIDController(rtol=1e-8, atol=1e-8, pcoeff=0.3, icoeff=0.4, dcoeff=0)
+            max_steps = 1_000_000
+        else:
+            stepsize_controller = ConstantStepSize()
+            max_steps = nsub * (t_steps - 1) + 16
+        
+        # The progress bar relies on host callbacks, so it is only enabled on request.
+        progress_meter = TqdmProgressMeter() if progress else NoProgressMeter()
+        
+        saveat = SaveAt(ts=t, fn=diagnostics) if diagnostics_only else SaveAt(ts=t)
+        
+        # Solve the ODE system.
+        sol = diffeqsolve(ODETerm(dy_dt), solver=Tsit5(), t0=jnp.zeros_like(t_max), t1=t_max, dt0=dt, y0=initial_conditions, 
+                          saveat=saveat, stepsize_controller=stepsize_controller, max_steps=max_steps, 
+                          progress_meter=progress_meter)
+        ys = sol.ys
+    
+    if diagnostics_only:
+        return ys, t
     
-    Ck = result[:,:(-6 * Nx * Ny * Nz)].reshape(len(t), Ns * Nn * Nm * Np, Nx, Ny, Nz)
-    Fk = result[:,(-6 * Nx * Ny * Nz):].reshape(len(t), 6, Nx, Ny, Nz)
+    Ck, Fk = ys['C'], ys['F']
     
     # jnp.save('Ck.npy', np.array(Ck))
     # jnp.save('Fk.npy', np.array(Fk))
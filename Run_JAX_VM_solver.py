@@ -1,12 +1,18 @@
 import json
 import jax
-jax.config.update("jax_enable_x64", True)
+# Double precision is opt-in. Set double_precision = False to run the solver in complex64.
+# Check the energy history when doing so: in the Kelvin-Helmholtz setup, single-precision round-off seeds the fast-growing
+# modes, and the total energy is not conserved even over short runs.
+double_precision = True
+jax.config.update("jax_enable_x64", double_precision)
 import jax.numpy as jnp
-from JAX_VM_solver import VM_simulation
+import numpy as np
+from JAX_VM_solver import VM_simulation, inverse_HF_transform_1D
+from Energy import inverse_Fourier_transform
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
 from scipy.signal import find_peaks
-from jax.numpy.fft import fft, ifftn, fftshift, ifftshift, fftfreq
+from jax.numpy.fft import fft, fftshift, fftfreq
 from jax.scipy.optimize import minimize
 import time
 
@@ -42,8 +48,10 @@ t_steps, t_max = parameters['t_steps'], parameters['t_max']
 #     file.write(f"nu: {nu}\n")
 #     file.write(f"t_steps, t_max: {t_steps}, {t_max}\n")
 
+# The number of time steps per output interval is estimated from the parameters (see estimate_substeps).
 start_time = time.time()
-Ck, Fk, t = VM_simulation(qs, nu, Omega_cs, alpha_s, mi_me, u_s, Lx, Ly, Lz, Nx, Ny, Nz, Nn, Nm, Np, Ns, t_max, t_steps)
+Ck, Fk, t = VM_simulation(qs, nu, Omega_cs, alpha_s, mi_me, u_s, Lx, Ly, Lz, Nx, Ny, Nz, Nn, Nm, Np, Ns, t_max, t_steps, 
+                          dtype=jnp.complex128 if double_precision else jnp.complex64)
 end_time = time.time()
 
 print(f"Runtime: {end_time - start_time} seconds")
@@ -55,20 +63,46 @@ print(f"Runtime: {end_time - start_time} seconds")
 lambda_D = jnp.sqrt(1 / (2 * (1 / alpha_s[0] ** 2 + 1 / (mi_me * alpha_s[3] ** 2))))
 k_norm = jnp.sqrt(2) * jnp.pi * alpha_s[0] / Lx
 
-dCk = Ck.at[:, 0, 1, 0, 0].set(0)
-dCk = dCk.at[:, Nn * Nm * Np, 1, 0, 0].set(0)
-
-C2 = jnp.mean(jnp.abs(dCk) ** 2, axis={-3, -2, -1})
-
-plasma_energy_0_Ck = (0.5 * ((0.5 * (alpha_s[0] ** 2 + alpha_s[1] ** 2 + alpha_s[2] ** 2)) * 
-                                        alpha_s[0] * alpha_s[1] * alpha_s[2] * Ck[:, 0, 1, 0, 0].real) + 
-                                0.5 * mi_me * ((0.5 * (alpha_s[3] ** 2 + alpha_s[4] ** 2 + alpha_s[5] ** 2)) * 
-                                                alpha_s[3] * alpha_s[4] * alpha_s[5] * Ck[:, Nn, 1, 0, 0].real))
-
-plasma_energy_2_Ck = (0.5 * (1 / jnp.sqrt(2)) * (alpha_s[0] ** 2) * Ck[:, 2, 1, 0, 0].real * alpha_s[0] * alpha_s[1] * alpha_s[2] + 
-                                0.5 * mi_me * (1 / jnp.sqrt(2)) * (alpha_s[3] ** 2) * Ck[:, Nn + 2, 1, 0, 0].real * alpha_s[3] * alpha_s[4] * alpha_s[5])
-
-electric_energy_Fk = 0.5 * jnp.mean(Fk[:, 0, :, 0, 0] ** 2, axis=-1) * Omega_cs[0] ** 2
+# Compute every quantity plotted below in a single jitted function, so that it is one dispatch and one transfer to the host.
+@jax.jit
+def plot_reductions(Ck, Fk, alpha_s, mi_me, Omega_ce):
+    
+    # dCk is Ck without the equilibrium coefficient (n = m = p = 0 at kx index 1). The slices of dCk plotted below are all
+    # at kx index 0, so they are read from Ck directly, without building dCk.
+    # Mean of |dCk|^2 over k, in the precision of Ck. The equilibrium coefficient is masked inside the reduction, and the
+    # reduction runs one time at a time, so neither a copy of Ck nor |dCk|^2 for the whole history is materialized.
+    equilibrium = np.zeros(Ck.shape[2:], dtype=bool)
+    equilibrium[0, 1, 0, 0] = True
+    C2 = jax.lax.map(lambda Ck_t: jnp.sum(jnp.where(equilibrium, 0, Ck_t.real ** 2 + Ck_t.imag ** 2), axis=(-3, -2, -1)), 
+                     Ck) / (Ck.shape[-3] * Ck.shape[-2] * Ck.shape[-1])
+    
+    plasma_energy_0_Ck = (0.5 * ((0.5 * (alpha_s[0] ** 2 + alpha_s[1] ** 2 + alpha_s[2] ** 2)) * 
+                                            alpha_s[0] * alpha_s[1] * alpha_s[2] * Ck[:, 0, 0, 1, 0, 0].real) + 
+                                    0.5 * mi_me * ((0.5 * (alpha_s[3] ** 2 + alpha_s[4] ** 2 + alpha_s[5] ** 2)) * 
+                                                    alpha_s[3] * alpha_s[4] * alpha_s[5] * Ck[:, 1, 0, 1, 0, 0].real))
+    
+    plasma_energy_2_Ck = (0.5 * (1 / jnp.sqrt(2)) * (alpha_s[0] ** 2) * Ck[:, 0, 2, 1, 0, 0].real * alpha_s[0] * alpha_s[1] * alpha_s[2] + 
+                                    0.5 * mi_me * (1 / jnp.sqrt(2)) * (alpha_s[3] ** 2) * Ck[:, 1, 2, 1, 0, 0].real * alpha_s[3] * alpha_s[4] * alpha_s[5])
+    
+    electric_energy_Fk = 0.5 * jnp.mean(Fk[:, 0, :, 0, 0] ** 2, axis=-1) * Omega_ce ** 2
+    
+    dCek = Ck[:, 0, 0, 0, 0, 0].imag
+    
+    return {'dCek': dCek,
+            'dCek_freq': fftshift(fft(dCek)),
+            'log_dCek': jnp.log10(jnp.abs(Ck[:, 0, 1, 0, 0, 0].imag)),
+            'log_dCik': jnp.log10(jnp.abs(Ck[:, 1, 0, 0, 0, 0].imag)),
+            'log_rhok': jnp.log10(jnp.abs(Ck[:, 1, 0, 0, 0, 0].imag * (alpha_s[3] * alpha_s[4] * alpha_s[5]) - 
+                                          Ck[:, 0, 0, 0, 0, 0].imag * (alpha_s[0] * alpha_s[1] * alpha_s[2]))),
+            'log_C2': jnp.log10(C2[:, 0]),
+            'plasma_energy_0_Ck': plasma_energy_0_Ck,
+            'plasma_energy_2_Ck': plasma_energy_2_Ck,
+            'electric_energy_Fk': electric_energy_Fk,
+            'total_energy': electric_energy_Fk + plasma_energy_2_Ck / 3}
+
+plot_data = jax.tree_util.tree_map(np.asarray, jax.block_until_ready(
+    plot_reductions(Ck, Fk, alpha_s, mi_me, Omega_cs[0])))
+dCek = plot_data['dCek']
 
 # plasma_energy_mov_avg = moving_average(plasma_energy_2_Ck / 3, 101)
 # electric_energy_mov_avg = moving_average(electric_energy_Fk, 101)
@@ -89,27 +123,27 @@ initial_params = jnp.array([5.0, 0.0, 1.0, 0.2])
 # Example time array and data array (replace 'data' with your actual data array)
 
 # Minimize the loss function to find the best-fit parameters
-optimized_result = minimize(lambda params: loss_function(params, t, dCk[:, 0, 0, 0, 0].imag), initial_params, method='BFGS', tol=1e-9)
+optimized_result = minimize(lambda params: loss_function(params, t, dCek), initial_params, method='BFGS', tol=1e-9)
 
 # Extract the best-fit parameters
 best_fit_params = optimized_result.x
 A, B, omega, gamma = best_fit_params
 
 
-dCek_freq = fftshift(fft(dCk[:, 0, 0, 0, 0].imag))
+dCek_freq = plot_data['dCek_freq']
 cos_exp_freq = fftshift(fft(jnp.cos(omega * t) * jnp.exp(-gamma * t)))
-freq = fftshift(fftfreq(len(dCk[:, 0, 0, 0, 0].imag), 0.1))
+freq = fftshift(fftfreq(len(dCek), 0.1))
 max_index = jnp.argmax(dCek_freq.real)
 
 
-peaks, _ = find_peaks(jnp.abs(dCk[:, 0, 0, 0, 0].imag))
-p = jnp.polyfit(t[peaks], jnp.log(jnp.abs(dCk[:, 0, 0, 0, 0].imag[peaks])), 1)
+peaks, _ = find_peaks(np.abs(dCek))
+p = jnp.polyfit(t[peaks], jnp.log(jnp.abs(dCek[peaks])), 1)
 
 
 # Plot |C000| vs t.
 
 plt.figure(figsize=(8, 6))
-plt.plot(t[:2000], jnp.log10(jnp.abs(dCk[:2000, 1, 0, 0, 0].imag)), label='$log_{10}(|\delta C_{e000,k}|)$', linestyle='-', color='red', linewidth=3.0)
+plt.plot(t[:2000], plot_data['log_dCek'][:2000], label='$log_{10}(|\delta C_{e000,k}|)$', linestyle='-', color='red', linewidth=3.0)
 # plt.plot(t, p[0] * t + p[1], label='$log_{10}(|\delta C_{e00}|^2)$', linestyle='-', color='black', linewidth=3.0)
 # plt.plot(t[peaks], jnp.log(jnp.abs(dCek[:, 0, 0, 0, 0].imag[peaks])), label='$log_{10}(|\delta C_{e00}|^2)$', linestyle='None', marker='x', color='blue', linewidth=3.0)
 # plt.plot(t, A * jnp.cos(omega * t) * jnp.exp(-gamma * t) + B, label='$A\cos(\omega t)e^{-\gamma t}+B$', linestyle='-', color='blue', linewidth=3.0)
@@ -123,7 +157,7 @@ plt.show()
 
 
 plt.figure(figsize=(8, 6))
-plt.plot(t[:1000], jnp.log10(jnp.abs(dCk[:1000, Nn * Nm * Np, 0, 0, 0].imag)), label='$log_{10}(|\delta C_{i000,k}|)$', linestyle='-', color='red', linewidth=3.0)
+plt.plot(t[:1000], plot_data['log_dCik'][:1000], label='$log_{10}(|\delta C_{i000,k}|)$', linestyle='-', color='red', linewidth=3.0)
 # plt.plot(t, p[0] * t + p[1], label='$log_{10}(|\delta C_{e00}|^2)$', linestyle='-', color='black', linewidth=3.0)
 # plt.plot(t[peaks], jnp.log(jnp.abs(dCek[:, 0, 0, 0, 0].imag[peaks])), label='$log_{10}(|\delta C_{e00}|^2)$', linestyle='None', marker='x', color='blue', linewidth=3.0)
 # plt.plot(t, A * jnp.cos(omega * t) * jnp.exp(-gamma * t) + B, label='$A\cos(\omega t)e^{-\gamma t}+B$', linestyle='-', color='blue', linewidth=3.0)
@@ -137,8 +171,7 @@ plt.show()
 
 
 plt.figure(figsize=(8, 6))
-plt.plot(t[:1000], jnp.log10(jnp.abs(dCk[:1000, Nn * Nm * Np, 0, 0, 0].imag * (alpha_s[3] * alpha_s[4] * alpha_s[5]) - 
-                                     dCk[:1000, 0, 0, 0, 0].imag * (alpha_s[0] * alpha_s[1] * alpha_s[2]))), 
+plt.plot(t[:1000], plot_data['log_rhok'][:1000], 
          label='$log_{10}(|\rho_k|)$', linestyle='-', color='red', linewidth=3.0)
 # plt.plot(t, p[0] * t + p[1], label='$log_{10}(|\delta C_{e00}|^2)$', linestyle='-', color='black', linewidth=3.0)
 # plt.plot(t[peaks], jnp.log(jnp.abs(dCek[:, 0, 0, 0, 0].imag[peaks])), label='$log_{10}(|\delta C_{e00}|^2)$', linestyle='None', marker='x', color='blue', linewidth=3.0)
@@ -184,7 +217,7 @@ plt.show()
 
 # Plot |C|^2 vs n vs t.
 plt.figure(figsize=(8, 6))
-plt.imshow(jnp.log10(C2[:1000, :Nn * Nm * Np]), aspect='auto', cmap='viridis', 
+plt.imshow(plot_data['log_C2'][:1000], aspect='auto', cmap='viridis', 
            interpolation='none', origin='lower', extent=(0, Nn, 0, 100), vmin=-10, vmax=10)
 plt.colorbar(label=r'$log_{10}(\langle |C_{e,n}|^2\rangle (t))$').ax.yaxis.label.set_size(16)
 
@@ -207,7 +240,7 @@ plt.figure(figsize=(8, 6))
 # plt.plot(t, (plasma_energy_0_Ck) / 3, label='Plasma energy ($C_{000}$)', linestyle='-', color='red', linewidth=3.0)
 # plt.plot(t[9:992], plasma_energy_mov_avg, label='mov_avg(Plasma energy)', linestyle='-', color='black', linewidth=3.0)
 # plt.plot(t, electric_energy_Fk, label='Electric energy', linestyle='-', color='blue', linewidth=3.0)
-plt.plot(t[:], electric_energy_Fk[:] + plasma_energy_2_Ck[:] / 3, label='Total energy in fluctuations', linestyle='-', color='red', linewidth=3.0)
+plt.plot(t[:], plot_data['total_energy'][:], label='Total energy in fluctuations', linestyle='-', color='red', linewidth=3.0)
 plt.xlabel(r'$t\omega_{pe}$', fontsize=16)
 plt.ylabel(r'Energy', fontsize=16)
 plt.xlim((0,t_max))
@@ -222,13 +255,11 @@ plt.show()
 ####################################################################################################################################################
 # Kelvin-Helmholtz instability.
 
-F = ifftn(ifftshift(Fk, axes=(-3, -2, -1)), axes=(-3, -2, -1))
+C, F = inverse_Fourier_transform(Ck, Fk, Nx, Ny, Nz)
 E, B = F[:, :3, ...].real, F[:, 3:, ...].real
-    
-C = ifftn(ifftshift(Ck, axes=(-3, -2, -1)), axes=(-3, -2, -1))
 
-Ce = C[:, :(Nn * Nm * Np), ...].real
-Ci = C[:, (Nn * Nm * Np):, ...].real
+Ce = C[:, 0, ...].real
+Ci = C[:, 1, ...].real
 
 Uex = (alpha_s[0] / jnp.sqrt(2)) * Ce[:, 1, ...] / Ce[:, 0, ...]
 Uey = (alpha_s[1] / jnp.sqrt(2)) * Ce[:, Nn, ...] / Ce[:, 0, ...]
@@ -283,26 +314,72 @@ plt.show()
 
 
 
+# Pull all frames to the host once so the animation loop does not dispatch to JAX.
+We_frames = np.asarray(jax.device_get(We))
+
+# Fix the color limits over all frames, so blitting only has to push new pixel data.
 fig, ax = plt.subplots()
-im = ax.imshow(We[0], cmap='viridis', interpolation='nearest')
+im = ax.imshow(We_frames[0], cmap='viridis', interpolation='nearest', vmin=We_frames.min(), vmax=We_frames.max())
 
 # Add a color bar
 cbar = plt.colorbar(im, ax=ax)
 cbar.set_label("$U_{ex}/c$") 
 
 # Set up the plot aesthetics
-title = ax.set_title("Frame 0")
+# The frame counter is an animated artist inside the axes, so it is covered by the blit region.
+title = ax.text(0.02, 0.95, "Frame 0", transform=ax.transAxes, color='w', animated=True)
 ax.axis('off')  # Optional: turn off axes for a cleaner look
 
 # Update function for the animation
 def update(frame):
-    im.set_array(We[frame])
+    im.set_array(We_frames[frame])
     title.set_text(f"Frame {frame}")
     return [im, title]
 
 # Create the animation
 anim = FuncAnimation(
-    fig, update, frames=We.shape[0], interval=50, blit=True  # Adjust interval as needed
+    fig, update, frames=We_frames.shape[0], interval=50, blit=True  # Adjust interval as needed
+)
+
+# Display the animation
+plt.show()
+
+
+# Phase space (x, vx) of electrons and ions along y = z = 0, on the velocity slice vy = u_y, vz = u_z.
+# Each species gets its own vx range, and the m, p Hermite modes are contracted analytically at xi_y = xi_z = 0.
+vx = jnp.array([jnp.linspace(-5 * alpha_s[s * 3] + u_s[s * 3], 5 * alpha_s[s * 3] + u_s[s * 3], 201) for s in range(Ns)])
+f_xvx = jax.vmap(inverse_HF_transform_1D, in_axes=(1, 0, 0, 0, None, None, None))(
+    C[..., 0:1, 0:1].real, alpha_s.reshape(Ns, 3), u_s.reshape(Ns, 3), vx, Nn, Nm, Np)
+
+# Pull all frames, as (species, t, vx, x), to the host once.
+f_frames = np.asarray(jax.device_get(jnp.swapaxes(f_xvx[:, :, :, 0, 0, :], -1, -2)))
+
+# squeeze=False keeps axes indexable by species when Ns == 1.
+fig, axes = plt.subplots(1, Ns, figsize=(6 * Ns, 5), squeeze=False)
+axes = axes[0]
+f_min, f_max = f_frames.min(axis=(1, 2, 3)), f_frames.max(axis=(1, 2, 3))
+phase_space_plots = [axes[s].imshow(f_frames[s, 0], aspect='auto', cmap='viridis', interpolation='none', origin='lower', 
+                                    extent=(0, Lx, vx[s, 0], vx[s, -1]), vmin=f_min[s], vmax=f_max[s]) for s in range(Ns)]
+# Species 0 and 1 are electrons and ions; any further species are labeled by their index.
+species_names = (['Electron', 'Ion'] + [f"Species {s}" for s in range(2, Ns)])[:Ns]
+species_labels = (['e', 'i'] + [str(s) for s in range(2, Ns)])[:Ns]
+for s, species in enumerate(species_names):
+    plt.colorbar(phase_space_plots[s], ax=axes[s]).set_label(f"$f_{{{species_labels[s]}}}(x, v_x)$")
+    axes[s].set_xlabel('$x/d_e$', fontsize=16)
+    axes[s].set_ylabel('$v_x/c$', fontsize=16)
+    axes[s].set_title(f"{species} phase space")
+phase_space_text = axes[0].text(0.02, 0.95, "Frame 0", transform=axes[0].transAxes, color='w', animated=True)
+
+# Update function for the animation
+def update_phase_space(frame):
+    for s in range(Ns):
+        phase_space_plots[s].set_array(f_frames[s, frame])
+    phase_space_text.set_text(f"Frame {frame}")
+    return phase_space_plots + [phase_space_text]
+
+# Create the animation
+phase_space_anim = FuncAnimation(
+    fig, update_phase_space, frames=f_frames.shape[1], interval=50, blit=True  # Adjust interval as needed
 )
 
 # Display the animation